@@ -1,31 +1,119 @@
 # streamlit_app.py
 
+import os
+
 import streamlit as st
 import geopandas as gpd
 import pydeck as pdk
-import matplotlib.pyplot as plt
-import matplotlib as mpl
 import streamlit.components.v1 as components
 import numpy as np
+import pandas as pd
 import altair as alt
+import shapely
+
+
+DATA_PATH = "data/forest_stands_with_elev.parquet"
 
 
-@st.cache_data
-def load_data():
-    gdf = gpd.read_file("data/forest_stands_with_elev.geojson")
+# cache_resource hands every rerun the same GeoDataFrame instead of unpickling
+# a copy; the app only reads it. The file mtime is part of the cache key so a
+# regenerated file is picked up without restarting the app, and max_entries=1
+# (here and on the helpers below) evicts the data of a superseded mtime.
+@st.cache_resource(max_entries=1)
+def load_data(mtime):
+    gdf = gpd.read_parquet(DATA_PATH)
     gdf = gdf.to_crs(epsg=4326)
-    # add color ramp based on canopy height
+    # add color ramp based on canopy height (green to red gradient),
+    # computed for all stands at once rather than row by row
     min_h, max_h = gdf.mean_canopy.min(), gdf.mean_canopy.max()
+    h = gdf.mean_canopy.to_numpy()
+    ratio = (h - min_h) / (max_h - min_h) if max_h > min_h else np.zeros_like(h)
+    colors = np.empty((len(h), 4), dtype=np.uint8)
+    colors[:, 0] = 255 * ratio
+    colors[:, 1] = 255 * (1 - ratio)
+    colors[:, 2] = 50
+    colors[:, 3] = 180
+
+    gdf["fill_color"] = colors.tolist()
+    return gdf
 
-    def height_to_color(h):
-        # green to red gradient
-        ratio = (h - min_h) / (max_h - min_h) if max_h > min_h else 0
-        r = int(255 * ratio)
-        g = int(255 * (1 - ratio))
-        return [r, g, 50, 180]
 
-    gdf["fill_color"] = gdf.mean_canopy.apply(height_to_color)
-    return gdf
+@st.cache_resource(max_entries=1)
+def load_layer_records(mtime):
+    """Pydeck records with the polygon rings as plain coordinate lists.
+
+    A PolygonLayer draws one polygon per record, so a multipart stand gets one
+    record per part, each carrying the stand's attributes. Stand i owns
+    records[offsets[i]:offsets[i + 1]]. The rings are sliced out of a single
+    shapely.to_ragged_array() call, so the geometries are converted once here
+    instead of on every rerun.
+    """
+    gdf = load_data(mtime)
+    geom_type, coords, offsets = shapely.to_ragged_array(gdf.geometry.values)
+    ring_offsets, part_offsets = offsets[0], offsets[1]
+    if geom_type == shapely.GeometryType.MULTIPOLYGON:
+        stand_offsets = offsets[2]
+    else:
+        # Plain polygons: every stand is exactly one part
+        stand_offsets = np.arange(len(gdf) + 1)
+    rings = [coords[a:b].tolist() for a, b in zip(ring_offsets[:-1], ring_offsets[1:])]
+    polygons = [rings[a:b] for a, b in zip(part_offsets[:-1], part_offsets[1:])]
+    records = [
+        {
+            "StandID": stand_id,
+            "mean_elev": mean_elev,
+            "mean_canopy": mean_canopy,
+            "fill_color": fill_color,
+            "polygon": polygon,
+        }
+        for stand_id, mean_elev, mean_canopy, fill_color, a, b in zip(
+            gdf.StandID.tolist(),
+            gdf.mean_elev.tolist(),
+            gdf.mean_canopy.tolist(),
+            gdf.fill_color,
+            stand_offsets[:-1],
+            stand_offsets[1:],
+        )
+        for polygon in polygons[a:b]
+    ]
+    return records, stand_offsets
+
+
+@st.cache_resource(max_entries=1)
+def load_stand_bounds(mtime):
+    """(N, 4) array of per-stand [minLon, minLat, maxLon, maxLat], computed once."""
+    return shapely.bounds(load_data(mtime).geometry.values)
+
+
+@st.cache_resource(max_entries=1)
+def load_canopy_order(mtime):
+    """Stands sorted by mean canopy height: positions, heights and Stand IDs as strings."""
+    gdf = load_data(mtime)
+    heights = gdf.mean_canopy.to_numpy()
+    order = np.argsort(heights, kind="stable")
+    return order, heights[order], gdf.StandID.to_numpy()[order].astype(str)
+
+
+@st.cache_data(max_entries=64)
+def compute_view(mtime, min_sel, max_sel):
+    """Everything derived from the slider range, cached for the last 64 ranges.
+
+    Returns the positions of the stands in range (in ascending canopy height
+    order), their bounds and the comma-separated Stand IDs sorted by
+    descending canopy height.
+    """
+    # The range is a contiguous run of the height-sorted stands, so two binary
+    # searches replace building a boolean mask over every row.
+    order, heights, sorted_ids = load_canopy_order(mtime)
+    lo, hi = np.searchsorted(heights, min_sel, "left"), np.searchsorted(heights, max_sel, "right")
+    idx = order[lo:hi]
+    # Reduce the cached per-stand boxes; an empty selection keeps the full extent.
+    b = load_stand_bounds(mtime)
+    if len(idx):
+        b = b[idx]
+    bounds = [b[:, 0].min(), b[:, 1].min(), b[:, 2].max(), b[:, 3].max()]
+    # The clipboard lists the same run of sorted IDs, highest canopy first
+    return idx, bounds, ",".join(sorted_ids[lo:hi][::-1])
 
 
 st.set_page_config(page_title="Forest Stands Canopy Height", layout="wide")
@@ -40,34 +128,39 @@ st.markdown(
     """
 )
 
-gdf = load_data()
+mtime = os.path.getmtime(DATA_PATH)
+gdf = load_data(mtime)
+records, record_offsets = load_layer_records(mtime)
 
 # Sidebar: filter by canopy height
 min_c, max_c = float(gdf.mean_canopy.min()), float(gdf.mean_canopy.max())
 sel = st.sidebar.slider("Canopy height range (m)", min_c, max_c, (min_c, max_c))
 
-# Sidebar: color legend for canopy height
-norm = mpl.colors.Normalize(vmin=min_c, vmax=max_c)
-sm = mpl.cm.ScalarMappable(norm=norm, cmap='RdYlGn_r')
-sm.set_array([])  # required for the colorbar
-
-fig, ax = plt.subplots(figsize=(4, 0.5))
-fig.colorbar(
-    sm,
-    cax=ax,
-    orientation='horizontal',
-    label='Mean Canopy Height (m)'
-)
-st.sidebar.pyplot(fig)
+# Sidebar: color legend for canopy height, drawn client-side by Vega-Lite
+# instead of rendering a matplotlib figure on every rerun
+edges = np.linspace(min_c, max_c, 257)
+legend_df = pd.DataFrame({"height": edges[:-1], "height_end": edges[1:]})
+legend = alt.Chart(legend_df).mark_rect().encode(
+    x=alt.X('height:Q', title='Mean Canopy Height (m)', scale=alt.Scale(domain=[min_c, max_c], nice=False)),
+    x2='height_end:Q',
+    color=alt.Color('height:Q', scale=alt.Scale(scheme='redyellowgreen', reverse=True), legend=None),
+).properties(height=40)
+st.sidebar.altair_chart(legend, use_container_width=True)
 
 # Compute the filtered df based on our sidebar selection
-filtered = gdf[(gdf.mean_canopy >= sel[0]) & (gdf.mean_canopy <= sel[1])]
+idx, bounds, ids_str = compute_view(mtime, sel[0], sel[1])
+if len(idx) == len(gdf):
+    # The whole range is selected (the initial state): use the cached data as is
+    filtered, layer_data = gdf, records
+else:
+    filtered = gdf.iloc[idx]
+    layer_data = [r for i in idx for r in records[record_offsets[i]:record_offsets[i + 1]]]
 
 # Build a Pydeck PolygonLayer for canopy height extrusion
 layer = pdk.Layer(
     "PolygonLayer",
-    data=filtered,
-    get_polygon="geometry.coordinates",
+    data=layer_data,
+    get_polygon="polygon",
     get_fill_color="fill_color",
     stroked=True,
     get_line_color=[0, 0, 0, 200],
@@ -80,7 +173,6 @@ layer = pdk.Layer(
 )
 
 # Compute viewport from filtered data bounds
-bounds = filtered.total_bounds  # [minLon, minLat, maxLon, maxLat]
 view_state = pdk.ViewState(
     latitude=(bounds[1] + bounds[3]) / 2,
     longitude=(bounds[0] + bounds[2]) / 2,
@@ -109,7 +201,7 @@ st.pydeck_chart(deck, use_container_width=True)
 
 
 st.subheader("Mean Forest Stand Canopy Height Scatter Plot")
-plot_df = filtered.sort_values("mean_canopy").copy()
+plot_df = filtered[["StandID", "mean_canopy"]].sort_values("mean_canopy")
 plot_df['StandID_str'] = plot_df['StandID'].astype(str)
 
 chart = alt.Chart(plot_df).mark_circle(size=60).encode(
@@ -129,8 +221,6 @@ st.dataframe(gdf)
 
 
 # Copy Stand IDs to clipboard
-ids = filtered.sort_values("mean_canopy", ascending=False)["StandID"].tolist()
-ids_str = ",".join(map(str, ids))
 components.html(
     f"""
 <div>